@@ -1,19 +1,24 @@
 import logging
 import math
 import os
+import io
 import json
 import shutil
 import zlib
 import base64
 import urllib.parse
 import urllib.request
+import urllib.response
 import urllib.error
+import http.client
 import platform
+import select
+import threading
 from datetime import datetime, timezone
 import dateutil.parser
 import ssl
 
-from .common import ClientError, LoginError, InvalidProject
+from .common import ClientError, LoginError, InvalidProject, DEFAULT_UPLOAD_CONCURRENCY
 from .merginproject import MerginProject
 from .client_pull import (
     download_file_finalize,
@@ -36,6 +41,74 @@ class TokenError(Exception):
     pass
 
 
+class KeepAliveHTTPSHandler(urllib.request.HTTPSHandler):
+    """
+    HTTPS handler that keeps the connection to the server open and reuses it for further requests
+    made from the same thread, saving TCP and TLS handshake for each of them. Response body is read
+    in full before returning, so it is only meant for requests with short responses (e.g. POST).
+    """
+
+    def __init__(self, context=None):
+        super().__init__(context=context)
+        self._local = threading.local()
+
+    def https_open(self, req):
+        if req._tunnel_host:
+            # going through a proxy - leave it to the standard handler
+            return super().https_open(req)
+
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        conn = self._local.connections.pop(req.host, None)
+        if conn is not None and self._is_connection_dropped(conn):
+            # server has closed the idle connection in the meantime
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self._new_connection(req)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+
+        try:
+            conn.request(req.get_method(), req.selector, req.data, headers)
+            r = conn.getresponse()
+            body = r.read()
+        except OSError as e:
+            # the request may have been processed by the server already, so we must not resend it
+            conn.close()
+            raise urllib.error.URLError(e)
+        except:  # noqa: E722
+            conn.close()
+            raise
+
+        if r.will_close:
+            conn.close()
+        else:
+            self._local.connections[req.host] = conn
+
+        resp = urllib.response.addinfourl(io.BytesIO(body), r.msg, req.get_full_url(), r.status)
+        resp.msg = r.reason
+        return resp
+
+    def _new_connection(self, req):
+        return http.client.HTTPSConnection(req.host, timeout=req.timeout, context=self._context)
+
+    @staticmethod
+    def _is_connection_dropped(conn):
+        """ Checks whether idle connection is still usable before we send another request over it """
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        # there should be nothing to read from an idle connection - either it got closed by the server
+        # or there is some unexpected data, in both cases we cannot use it
+        return bool(readable)
+
+
 def decode_token_data(token):
     token_prefix = "Bearer ."
     if not token.startswith(token_prefix):
@@ -62,9 +135,22 @@ class MerginClient:
     :param proxy_config: Dictionary, proxy settings to use when connecting to Mergin service. At least url and port
         of the server should be provided. Expected keys: "url", "port", "user", "password".
         Currently, only HTTP proxies are supported.
+    :param upload_concurrency: Integer, number of chunks uploaded in parallel during push (at least 1). Defaults to
+        MERGIN_UPLOAD_CONCURRENCY environment variable if set to a valid value, otherwise to DEFAULT_UPLOAD_CONCURRENCY.
     """
-    def __init__(self, url=None, auth_token=None, login=None, password=None, plugin_version=None, proxy_config=None):
+    def __init__(self, url=None, auth_token=None, login=None, password=None, plugin_version=None, proxy_config=None,
+                 upload_concurrency=None):
         self.url = url if url is not None else MerginClient.default_url()
+        if upload_concurrency is None:
+            try:
+                upload_concurrency = int(os.environ.get('MERGIN_UPLOAD_CONCURRENCY', DEFAULT_UPLOAD_CONCURRENCY))
+            except ValueError:
+                upload_concurrency = DEFAULT_UPLOAD_CONCURRENCY
+            if upload_concurrency < 1:
+                upload_concurrency = DEFAULT_UPLOAD_CONCURRENCY
+        elif upload_concurrency < 1:
+            raise ClientError(f"Invalid upload concurrency: {upload_concurrency} (needs to be at least 1)")
+        self.upload_concurrency = upload_concurrency
         self._auth_params = None
         self._auth_session = None
         self._user_info = None
@@ -102,17 +188,23 @@ class MerginClient:
         # is fixed.
         default_capath = ssl.get_default_verify_paths().openssl_capath
         if os.path.exists(default_capath):
-            self.opener = urllib.request.build_opener(*handlers, urllib.request.HTTPSHandler())
+            ctx = None
         else:
             cafile = os.path.join(this_dir, 'cert.pem')
             if not os.path.exists(cafile):
                 raise Exception("missing " + cafile)
             ctx = ssl.SSLContext()
             ctx.load_verify_locations(cafile)
-            https_handler = urllib.request.HTTPSHandler(context=ctx)
-            self.opener = urllib.request.build_opener(*handlers, https_handler)
+        self.opener = urllib.request.build_opener(*handlers, urllib.request.HTTPSHandler(context=ctx))
         urllib.request.install_opener(self.opener)
 
+        # POST requests (e.g. upload of chunks during push) come in quick succession and have short
+        # responses, so we keep connections open for them (one per thread) rather than connecting every time
+        if proxy_config is None:
+            self.post_opener = urllib.request.build_opener(KeepAliveHTTPSHandler(context=ctx))
+        else:
+            self.post_opener = self.opener
+
         if login and not password:
             raise ClientError("Unable to log in: no password provided for '{}'".format(login))
         if password and not login:
@@ -179,13 +271,15 @@ class MerginClient:
         return wrapper
 
     @_check_token
-    def _do_request(self, request):
+    def _do_request(self, request, opener=None):
         """General server request method."""
         if self._auth_session:
             request.add_header("Authorization", self._auth_session["token"])
         request.add_header("User-Agent", self.user_agent_info())
+        if opener is None:
+            opener = self.opener
         try:
-            return self.opener.open(request)
+            return opener.open(request)
         except urllib.error.HTTPError as e:
             if e.headers.get("Content-Type", "") == "application/problem+json":
                 info = json.load(e)
@@ -207,7 +301,7 @@ class MerginClient:
         if headers.get("Content-Type", None) == "application/json":
             data = json.dumps(data, cls=DateTimeEncoder).encode("utf-8")
         request = urllib.request.Request(url, data, headers, method="POST")
-        return self._do_request(request)
+        return self._do_request(request, self.post_opener)
 
     def is_server_compatible(self):
         """
@@ -10,6 +10,7 @@ To finish the download job, we have to call download_project_finalize(job).
 """
 
 import copy
+import logging
 import math
 import os
 import pprint
@@ -380,7 +381,8 @@ def pull_project_async(mc, directory):
     temp_dir = mp.fpath_meta(f'fetch_{local_version}-{server_version}')
     os.makedirs(temp_dir, exist_ok=True)
     pull_changes = mp.get_pull_changes(server_info["files"])
-    mp.log.debug("pull changes:\n" + pprint.pformat(pull_changes))
+    if mp.log.isEnabledFor(logging.DEBUG):
+        mp.log.debug("pull changes:\n" + pprint.pformat(pull_changes))
     fetch_files = []
     for f in pull_changes["added"]:
         f['version'] = server_version
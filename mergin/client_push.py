@@ -9,14 +9,22 @@ push_project_wait(job) that will block the current thread (not good for GUI).
 To finish the upload job, we have to call push_project_finalize(job).
 """
 
-import json
 import hashlib
+import itertools
+import logging
+import os
 import pprint
 import tempfile
+import threading
 import concurrent.futures
 
 from .common import UPLOAD_CHUNK_SIZE, ClientError
 from .merginproject import MerginProject
+from .utils import load_json
+
+
+# size of pieces in which the chunk data are sent (we check for cancellation between them)
+_UPLOAD_BLOCK_SIZE = 64 * 1024
 
 
 class UploadJob:
@@ -29,13 +37,42 @@ class UploadJob:
         self.total_size = 0                    # size of data to upload (in bytes)
         self.transferred_size = 0              # size of data already uploaded (in bytes)
         self.upload_queue_items = []           # list of items to upload in the background
+        self.file_handles = {}                 # SharedFileHandle of each uploaded file (keyed by file path)
         self.mp = mp                           # MerginProject instance
         self.mc = mc                           # MerginClient instance
         self.tmp_dir = tmp_dir                 # TemporaryDirectory instance for any temp file we need
-        self.is_cancelled = False              # whether upload has been cancelled
+        self.cancel_event = threading.Event()  # set when upload has been cancelled
         self.executor = None                   # ThreadPoolExecutor that manages background upload tasks
         self.futures = []                      # list of futures submitted to the executor
+        self.pending_uploads = 0               # number of submitted uploads that have not finished yet
+        self.upload_error = None               # first exception raised by any of the uploads
         self.server_resp = None                # server response when transaction is finished
+        self.lock = threading.Lock()           # guards updates of the job from worker threads
+
+    @property
+    def is_cancelled(self):
+        """ Whether upload has been cancelled """
+        return self.cancel_event.is_set()
+
+    @is_cancelled.setter
+    def is_cancelled(self, value):
+        # kept for callers that cancel the job by setting the flag directly
+        if value:
+            self.cancel_event.set()
+        else:
+            self.cancel_event.clear()
+
+    def add_transferred_size(self, size):
+        """ Called from worker threads when a chunk has been uploaded """
+        with self.lock:
+            self.transferred_size += size
+
+    def upload_finished(self, future):
+        """ Called when upload of a chunk is done (successfully, with an error or it got cancelled) """
+        with self.lock:
+            self.pending_uploads -= 1
+            if self.upload_error is None and not future.cancelled() and future.exception() is not None:
+                self.upload_error = future.exception()
 
     def dump(self):
         print("--- JOB ---", self.total_size, "bytes")
@@ -44,37 +81,139 @@ class UploadJob:
         print("--- END ---")
 
 
-class UploadQueueItem:
-    """ A single chunk of data that needs to be uploaded """
+class CancellableBody:
+    """
+    Request body that reads the chunk from the file and sends it in small blocks, stopping the upload
+    (with ClientError) as soon as the job gets cancelled, rather than sending the whole chunk anyway.
+    If requested, SHA1 checksum of the chunk is calculated on the fly while the blocks are being sent.
+    The body can be iterated multiple times (each iteration starts the checksum from scratch).
+    """
 
-    def __init__(self, file_path, size, transaction_id, chunk_id, chunk_index):
-        self.file_path = file_path            # full path to the file
-        self.size = size                      # size of the chunk in bytes
-        self.chunk_id = chunk_id              # ID of the chunk within transaction
-        self.chunk_index = chunk_index        # index (starting from zero) of the chunk within the file
-        self.transaction_id = transaction_id  # ID of the transaction
+    def __init__(self, file_handle, offset, size, cancel_event, with_checksum=False):
+        self.file_handle = file_handle      # SharedFileHandle of the file to read from
+        self.offset = offset                # offset of the chunk within the file
+        self.size = size                    # size of the chunk in bytes
+        self.cancel_event = cancel_event    # threading.Event that is set when upload has been cancelled
+        self.with_checksum = with_checksum  # whether to calculate checksum of the sent data
+        self.checksum = None                # hashlib object with checksum of the data sent so far
+
+    def __iter__(self):
+        checksum = hashlib.sha1() if self.with_checksum else None
+        self.checksum = checksum
+        for block in self.file_handle.read_blocks(self.offset, self.size):
+            if self.cancel_event.is_set():
+                raise ClientError("Upload has been cancelled")
+            if checksum is not None:
+                checksum.update(block)
+            yield block
 
-    def upload_blocking(self, mc, mp):
 
-        with open(self.file_path, 'rb') as file_handle:
-            file_handle.seek(self.chunk_index * UPLOAD_CHUNK_SIZE)
-            data = file_handle.read(UPLOAD_CHUNK_SIZE)
+class UploadQueueItem:
+    """ A single chunk of data that needs to be uploaded """
+
+    # there is one instance per chunk, which may be a lot for large projects
+    __slots__ = ('file_path', 'size', 'chunk_id', 'chunk_index', 'transaction_id', 'expected_checksum', 'url')
+
+    def __init__(self, file_path, size, transaction_id, chunk_id, chunk_index, expected_checksum=None):
+        self.file_path = file_path                  # full path to the file
+        self.size = size                            # size of the chunk in bytes
+        self.chunk_id = chunk_id                    # ID of the chunk within transaction
+        self.chunk_index = chunk_index              # index (starting from zero) of the chunk within the file
+        self.transaction_id = transaction_id        # ID of the transaction
+        self.expected_checksum = expected_checksum  # SHA1 of the chunk if already known (otherwise calculated on upload)
+        self.url = f"/v1/project/push/chunk/{transaction_id}/{chunk_id}"  # where to upload the chunk
+
+    def upload_blocking(self, mc, mp, file_handle, cancel_event):
+
+        offset = self.chunk_index * UPLOAD_CHUNK_SIZE
+        # submit read of the whole chunk at once, so that the kernel can load it in the background
+        # while we are sending the beginning of it
+        file_handle.prefetch(offset, self.size)
+
+        mp.log.debug(f"Uploading {self.file_path} part={self.chunk_index}")
+
+        # the chunk is read and sent in small blocks rather than loaded into memory as a whole,
+        # so we need to tell its length upfront (otherwise chunked encoding would be used)
+        headers = {"Content-Type": "application/octet-stream", "Content-Length": str(self.size)}
+        body = CancellableBody(file_handle, offset, self.size, cancel_event,
+                               with_checksum=self.expected_checksum is None)
+        resp = mc.post(self.url, body, headers)
+        resp_dict = load_json(resp)
+        mp.log.debug(f"Upload finished: {self.file_path}")
+        if self.expected_checksum is None:
+            expected_checksum = body.checksum.hexdigest()
+        else:
+            expected_checksum = self.expected_checksum
+        if not (resp_dict['size'] == self.size and resp_dict['checksum'] == expected_checksum):
+            try:
+                mc.post("/v1/project/push/cancel/{}".format(self.transaction_id))
+            except ClientError:
+                pass
+            raise ClientError("Mismatch between uploaded file chunk {} and local one".format(self.chunk_id))
 
-            checksum = hashlib.sha1()
-            checksum.update(data)
 
-            mp.log.debug(f"Uploading {self.file_path} part={self.chunk_index}")
+class SharedFileHandle:
+    """
+    Read-only file descriptor shared by chunks of a file that are being uploaded at the same time.
+    It gets opened when upload of a chunk starts and closed as soon as no chunk of the file is
+    in progress, so at most one descriptor per worker is open, however large the project is.
+    Reads use explicit offsets (pread), so chunks can be read from multiple threads at once.
+    """
 
-            headers = {"Content-Type": "application/octet-stream"}
-            resp = mc.post("/v1/project/push/chunk/{}/{}".format(self.transaction_id, self.chunk_id), data, headers)
-            resp_dict = json.load(resp)
-            mp.log.debug(f"Upload finished: {self.file_path}")
-            if not (resp_dict['size'] == len(data) and resp_dict['checksum'] == checksum.hexdigest()):
-                try:
-                    mc.post("/v1/project/push/cancel/{}".format(self.transaction_id))
-                except ClientError:
-                    pass
-                raise ClientError("Mismatch between uploaded file chunk {} and local one".format(self.chunk_id))
+    def __init__(self, file_path):
+        self.file_path = file_path    # full path to the file
+        self.users = 0                # number of chunks of the file being uploaded right now
+        self.fd = None                # file descriptor (only while some of its chunks are being uploaded)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ To be called before upload of a chunk, opens the file if needed """
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                if hasattr(os, 'posix_fadvise'):
+                    # let the kernel read ahead while the previous block is being sent over network
+                    os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            self.users += 1
+
+    def release(self):
+        """ To be called when upload of a chunk has finished (successfully or not) """
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self._close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def prefetch(self, offset, size):
+        """ Asks the kernel to start loading the given range of the file in the background """
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd, offset, size, os.POSIX_FADV_WILLNEED)
+
+    def read_blocks(self, offset, size):
+        """ Yields content of the given range of the file in blocks of _UPLOAD_BLOCK_SIZE bytes """
+        end = offset + size
+        while offset < end:
+            block = self._pread(min(_UPLOAD_BLOCK_SIZE, end - offset), offset)
+            if not block:
+                raise ClientError(f"File {self.file_path} has been modified during upload")
+            offset += len(block)
+            yield block
+
+    def _pread(self, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, size, offset)
+        # there is no pread on Windows - make sure other threads do not move the file position meanwhile
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 
 def push_project_async(mc, directory):
@@ -111,7 +250,8 @@ def push_project_async(mc, directory):
                           f"\n\nLocal version: {local_version}\nServer version: {server_version}")
 
     changes = mp.get_push_changes()
-    mp.log.debug("push changes:\n" + pprint.pformat(changes))
+    if mp.log.isEnabledFor(logging.DEBUG):
+        mp.log.debug("push changes:\n" + pprint.pformat(changes))
 
     tmp_dir = tempfile.TemporaryDirectory(prefix="mergin-py-client-")
 
@@ -154,7 +294,7 @@ def push_project_async(mc, directory):
         mp.log.error("Error starting transaction: " + str(err))
         mp.log.info("--- push aborted")
         raise
-    server_resp = json.load(resp)
+    server_resp = load_json(resp)
 
     upload_files = data['changes']["added"] + data['changes']["updated"]
 
@@ -169,7 +309,7 @@ def push_project_async(mc, directory):
 
     mp.log.info(f"got transaction ID {transaction_id}")
 
-    upload_queue_items = []
+    file_queue_items = []   # list of chunks for each of the files
     total_size = 0
     # prepare file chunks for upload
     for file in upload_files:
@@ -177,30 +317,51 @@ def push_project_async(mc, directory):
             # versioned file - uploading diff
             file_location = mp.fpath_meta(file['diff']['path'])
             file_size = file['diff']['size']
+            file_checksum = file['diff']['checksum']
         elif "upload_file" in file:
             # versioned file - uploading full (a temporary copy)
             file_location = file["upload_file"]
             file_size = file["size"]
+            file_checksum = file["checksum"]
         else:
             # non-versioned file
             file_location = mp.fpath(file['path'])
             file_size = file['size']
-
-        for chunk_index, chunk_id in enumerate(file["chunks"]):
-            size = min(UPLOAD_CHUNK_SIZE, file_size - chunk_index * UPLOAD_CHUNK_SIZE)
-            upload_queue_items.append(UploadQueueItem(file_location, size, transaction_id, chunk_id, chunk_index))
-
+            file_checksum = file['checksum']
+
+        # if the whole file fits into a single chunk, its checksum has been calculated already
+        chunks = file["chunks"]
+        chunk_checksum = file_checksum if len(chunks) == 1 else None
+
+        # all chunks have full size except for the last one
+        last_index = len(chunks) - 1
+        last_size = file_size - last_index * UPLOAD_CHUNK_SIZE
+        file_queue_items.append([
+            UploadQueueItem(file_location, UPLOAD_CHUNK_SIZE if chunk_index < last_index else last_size,
+                            transaction_id, chunk_id, chunk_index, chunk_checksum)
+            for chunk_index, chunk_id in enumerate(chunks)
+        ])
+
+        if chunks:
+            job.file_handles[file_location] = SharedFileHandle(file_location)
         total_size += file_size
 
+    # interleave chunks of different files, so that upload of large files gets started right away
+    # rather than waiting in the queue until all the preceding files have been uploaded
+    upload_queue_items = [item for items in itertools.zip_longest(*file_queue_items) for item in items
+                          if item is not None]
+
     job.total_size = total_size
     job.upload_queue_items = upload_queue_items
 
     mp.log.info(f"will upload {len(upload_queue_items)} items with total size {total_size}")
 
     # start uploads in background
-    job.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    job.executor = concurrent.futures.ThreadPoolExecutor(max_workers=_upload_workers(mc))
+    job.pending_uploads = len(upload_queue_items)
     for item in upload_queue_items:
         future = job.executor.submit(_do_upload, item, job)
+        future.add_done_callback(job.upload_finished)
         job.futures.append(future)
 
     return job
@@ -219,14 +380,14 @@ def push_project_is_running(job):
     It also forwards any exceptions from workers (e.g. some network errors). If an exception
     is raised, it is advised to call push_project_cancel() to abort the job.
     """
-    for future in job.futures:
-        if future.done() and future.exception() is not None:
-            job.mp.log.error("Error while pushing data: " + str(future.exception()))
-            job.mp.log.info("--- push aborted")
-            raise future.exception()
-        if future.running():
-            return True
-    return False
+    with job.lock:
+        upload_error = job.upload_error
+        pending_uploads = job.pending_uploads
+    if upload_error is not None:
+        job.mp.log.error("Error while pushing data: " + str(upload_error))
+        job.mp.log.info("--- push aborted")
+        raise upload_error
+    return pending_uploads > 0
 
 
 def push_project_finalize(job):
@@ -243,6 +404,7 @@ def push_project_finalize(job):
 
     if with_upload_of_files:
         job.executor.shutdown(wait=True)
+        _close_file_handles(job)
 
         # make sure any exceptions from threads are not lost
         for future in job.futures:
@@ -251,6 +413,11 @@ def push_project_finalize(job):
                 job.mp.log.info("--- push aborted")
                 raise future.exception()
 
+        # all uploads are done - release per-chunk objects (there may be lots of them for large projects)
+        job.upload_queue_items.clear()
+        job.futures.clear()
+        job.file_handles.clear()
+
     if job.transferred_size != job.total_size:
         error_msg = "Transferred size ({}) and expected total size ({}) do not match!".format(job.transferred_size, job.total_size)
         job.mp.log.error("--- push finish failed! " + error_msg)
@@ -260,7 +427,7 @@ def push_project_finalize(job):
         try:
             job.mp.log.info(f"Finishing transaction {job.transaction_id}")
             resp = job.mc.post("/v1/project/push/finish/%s" % job.transaction_id)
-            job.server_resp = json.load(resp)
+            job.server_resp = load_json(resp)
         except ClientError as err:
             # server returns various error messages with filename or something generic
             # it would be better if it returned list of failed files (and reasons) whenever possible
@@ -300,10 +467,14 @@ def push_project_cancel(job):
     """
 
     job.mp.log.info("user cancelled the push...")
-    # set job as cancelled
-    job.is_cancelled = True
+    # set job as cancelled (this also interrupts uploads in progress)
+    job.cancel_event.set()
 
+    # drop uploads that have not started yet, so that we only wait for those in progress
+    for future in job.futures:
+        future.cancel()
     job.executor.shutdown(wait=True)
+    _close_file_handles(job)
     try:
         resp_cancel = job.mc.post("/v1/project/push/cancel/%s" % job.transaction_id)
         job.server_resp = resp_cancel.msg
@@ -313,10 +484,29 @@ def push_project_cancel(job):
     job.mp.log.info("--- push cancel response: " + str(job.server_resp))
 
 
+def _upload_workers(mc):
+    """
+    Returns number of worker threads to use for upload. Bounded by CPU count so that
+    we do not end up with an excessive number of threads and connections to the server.
+    """
+    return max(1, min(mc.upload_concurrency, (os.cpu_count() or 1) * 4))
+
+
+def _close_file_handles(job):
+    """ Closes files that may have been left open by uploads that did not finish """
+    for file_handle in job.file_handles.values():
+        file_handle.close()
+
+
 def _do_upload(item, job):
     """ runs in worker thread """
     if job.is_cancelled:
         return
 
-    item.upload_blocking(job.mc, job.mp)
-    job.transferred_size += item.size
+    file_handle = job.file_handles[item.file_path]
+    file_handle.acquire()
+    try:
+        item.upload_blocking(job.mc, job.mp, file_handle, job.cancel_event)
+    finally:
+        file_handle.release()
+    job.add_transferred_size(item.size)
@@ -7,6 +7,9 @@ CHUNK_SIZE = 100 * 1024 * 1024
 # there is an upper limit for chunk size on server, ideally should be requested from there once implemented
 UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024
 
+# default number of chunks being uploaded in parallel (each by its own worker thread and connection)
+DEFAULT_UPLOAD_CONCURRENCY = 8
+
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -31,8 +34,13 @@ except ImportError:
     deps_dir = os.path.join(this_dir, 'deps')
     if os.path.exists(deps_dir):
         import sys
-        for f in os.listdir(os.path.join(deps_dir)):
-            sys.path.append(os.path.join(deps_dir, f))
+        # avoid adding the same entries again (e.g. when the module gets reloaded), every entry
+        # in sys.path makes lookup of modules that are not found there slower
+        known_paths = set(sys.path)
+        for f in os.listdir(deps_dir):
+            path = os.path.join(deps_dir, f)
+            if path not in known_paths:
+                sys.path.append(path)
 
         import dateutil.parser
         from dateutil.tz import tzlocal
@@ -1,23 +1,38 @@
+import io
 import json
+import hashlib
+import http.client
+import http.server
 import logging
 import os
 import tempfile
+import threading
 import subprocess
 import shutil
+import urllib.request
 from datetime import datetime, timedelta
 import pytest
 import pytz
 import sqlite3
 
 from .. import InvalidProject
-from ..client import MerginClient, ClientError, MerginProject, LoginError, decode_token_data, TokenError
-from ..client_push import push_project_async, push_project_cancel
+from ..client import (
+    MerginClient,
+    ClientError,
+    MerginProject,
+    LoginError,
+    decode_token_data,
+    TokenError,
+    KeepAliveHTTPSHandler
+)
+from ..client_push import push_project_async, push_project_cancel, SharedFileHandle, CancellableBody
 from ..utils import (
     generate_checksum,
     get_versions_with_file_changes,
     unique_path_name,
     conflicted_copy_file_name,
-    edit_conflict_file_name
+    edit_conflict_file_name,
+    load_json
 )
 from ..merginproject import pygeodiff
 from ..report import create_report
@@ -1662,3 +1677,133 @@ def test_report(mc):
     shutil.rmtree(directory)
     with pytest.raises(InvalidProject):
         create_report(mc, directory, since, to, report_file)
+
+
+class _LocalRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Minimal server answering POST requests like the chunk upload endpoint """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.server.connections += 1
+        super().setup()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(self.path)
+        if self.path == "/drop":
+            # request gets processed, but the connection is closed without any response
+            self.close_connection = True
+            return
+        if self.path == "/problem":
+            status, content_type, data = 400, "application/problem+json", {"detail": "Something is wrong"}
+        else:
+            status, content_type = 200, "application/json"
+            data = {"size": len(body), "checksum": hashlib.sha1(body).hexdigest()}
+        out = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        # server closes the connection after responding, without telling the client in advance
+        self.close_connection = self.path == "/close-after"
+
+    def log_message(self, *args):
+        pass
+
+
+class _PlainKeepAliveHandler(KeepAliveHTTPSHandler):
+    """ KeepAliveHTTPSHandler working over plain HTTP, so that it can be tested with a local server """
+    handler_order = 499   # take precedence over the default HTTP handler
+    http_open = KeepAliveHTTPSHandler.https_open
+
+    def _new_connection(self, req):
+        return http.client.HTTPConnection(req.host, timeout=req.timeout)
+
+
+@pytest.fixture(scope='function')
+def local_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _LocalRequestHandler)
+    server.connections = 0
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _local_client(server):
+    client = MerginClient(f"http://127.0.0.1:{server.server_port}")
+    client.post_opener = urllib.request.build_opener(_PlainKeepAliveHandler())
+    return client
+
+
+def test_keep_alive_connection_reuse(local_server):
+    client = _local_client(local_server)
+    for i in range(3):
+        resp = client.post("/chunk", b"x" * i, {"Content-Type": "application/octet-stream"})
+        assert load_json(resp)["size"] == i
+    assert local_server.connections == 1
+
+    # server has closed the idle connection - a new one must be used and the request sent only once
+    client.post("/close-after", b"x", {"Content-Type": "application/octet-stream"})
+    resp = client.post("/chunk", b"xy", {"Content-Type": "application/octet-stream"})
+    assert load_json(resp)["size"] == 2
+    assert local_server.connections == 2
+    assert local_server.requests == ["/chunk"] * 3 + ["/close-after", "/chunk"]
+
+
+def test_keep_alive_error_response(local_server):
+    client = _local_client(local_server)
+    with pytest.raises(ClientError, match="Something is wrong"):
+        client.post("/problem", b"x", {"Content-Type": "application/octet-stream"})
+    # connection is still usable after error response
+    resp = client.post("/chunk", b"x", {"Content-Type": "application/octet-stream"})
+    assert load_json(resp)["size"] == 1
+    assert local_server.connections == 1
+
+
+def test_keep_alive_no_resend(local_server):
+    """ Request that may have been processed by the server must not be sent again """
+    client = _local_client(local_server)
+    client.post("/chunk", b"x", {"Content-Type": "application/octet-stream"})
+    with pytest.raises(ClientError):
+        client.post("/drop", b"x", {"Content-Type": "application/octet-stream"})
+    assert local_server.requests == ["/chunk", "/drop"]
+
+
+def test_load_json():
+    assert load_json(io.BytesIO(b'{"a": [1, 2], "b": null}')) == {"a": [1, 2], "b": None}
+
+
+def test_cancellable_body():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "data.bin")
+        content = os.urandom(5 * 64 * 1024 + 10)
+        with open(path, "wb") as f:
+            f.write(content)
+
+        file_handle = SharedFileHandle(path)
+        file_handle.acquire()
+        cancel_event = threading.Event()
+        body = CancellableBody(file_handle, 0, len(content), cancel_event, with_checksum=True)
+        # body can be sent repeatedly, checksum is always of a single pass
+        for _ in range(2):
+            assert b"".join(body) == content
+            assert body.checksum.hexdigest() == hashlib.sha1(content).hexdigest()
+
+        # cancelled in the middle of sending
+        sent = []
+        with pytest.raises(ClientError, match="cancelled"):
+            for block in body:
+                sent.append(block)
+                cancel_event.set()
+        assert len(sent) == 1
+
+        # file is shorter than expected (e.g. modified during upload)
+        with pytest.raises(ClientError, match="modified during upload"):
+            list(file_handle.read_blocks(64 * 1024, len(content)))
+
+        file_handle.release()
+        assert file_handle.fd is None
@@ -8,17 +8,27 @@ from datetime import datetime
 from pathlib import Path
 from .common import ClientError
 
+# optional faster JSON parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def generate_checksum(file, chunk_size=4096):
+
+def generate_checksum(file, chunk_size=1024 * 1024):
     """
     Generate checksum for file from chunks.
 
     :param file: file to calculate checksum
-    :param chunk_size: size of chunk
+    :param chunk_size: size of chunk (ignored on Python 3.11+ where hashlib.file_digest is used)
     :return: sha1 checksum
     """
-    checksum = hashlib.sha1()
     with open(file, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # reads into a reusable buffer without allocating a bytes object per chunk
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+
+        checksum = hashlib.sha1()
         while True:
             chunk = f.read(chunk_size)
             if not chunk:
@@ -60,6 +70,16 @@ class DateTimeEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+def load_json(stream):
+    """
+    Parse JSON document from a readable object (e.g. server response).
+    Uses orjson when available as it is considerably faster for large documents.
+    """
+    if orjson is not None:
+        return orjson.loads(stream.read())
+    return json.load(stream)
+
+
 def find(items, fn):
     for item in items:
         if fn(item):